@@ -1,9 +1,16 @@
 import os
-import requests
+import asyncio
+import duckdb
+import httpx
+import orjson
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from dotenv import load_dotenv
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Explicitly load the .env file from the script's directory
 load_dotenv(dotenv_path=Path(__file__).parent / '.env')
@@ -12,7 +19,57 @@ TOKEN = os.getenv("TRAVELPAYOUTS_TOKEN")
 BASE = "https://api.travelpayouts.com/v2/prices/latest"
 
 
-def fetch_route(origin, destination):
+def write_csv(df, path):
+    # Arrow's multi-threaded C++ writer instead of DataFrame.to_csv
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), str(path))
+
+
+# Explicit schema for the DuckDB flights table, so it doesn't depend on
+# whichever fields the API returned on the first run
+FLIGHTS_SCHEMA = {
+    "depart_date": "VARCHAR",
+    "origin": "VARCHAR",
+    "destination": "VARCHAR",
+    "gate": "VARCHAR",
+    "return_date": "VARCHAR",
+    "found_at": "VARCHAR",
+    "trip_class": "BIGINT",
+    "price_eur": "DOUBLE",
+    "number_of_changes": "BIGINT",
+    "duration": "BIGINT",
+    "distance": "BIGINT",
+    "show_to_affiliates": "BOOLEAN",
+    "actual": "BOOLEAN",
+    "collection_timestamp": "VARCHAR",
+    "snapshot_date": "VARCHAR"
+}
+
+
+def save_to_duckdb(df, db_path, snapshot_date):
+    # Append the snapshot to the shared flights table; re-running on the same
+    # day replaces that day's rows. Fields outside FLIGHTS_SCHEMA are skipped
+    columns = ", ".join(col for col in FLIGHTS_SCHEMA if col in df.columns)
+    con = duckdb.connect(str(db_path))
+    try:
+        con.register("snapshot_df", df)
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS flights ("
+            + ", ".join(f"{col} {col_type}" for col, col_type in FLIGHTS_SCHEMA.items())
+            + ")"
+        )
+        con.execute("BEGIN TRANSACTION")
+        try:
+            con.execute("DELETE FROM flights WHERE snapshot_date = ?", [snapshot_date])
+            con.execute(f"INSERT INTO flights ({columns}) SELECT {columns} FROM snapshot_df")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    finally:
+        con.close()
+
+
+async def fetch_route(client, origin, destination):
     params = {
         "currency": "eur",
         "origin": origin,
@@ -22,20 +79,39 @@ def fetch_route(origin, destination):
         "limit": 30
     }
     try:
-        resp = requests.get(BASE, headers={"x-access-token": TOKEN}, params=params)
+        resp = await client.get(BASE, params=params)
         resp.raise_for_status()
         try:
-            data = resp.json()["data"]
+            data = orjson.loads(resp.content)["data"]
         except Exception as e:
             print(f"JSON decode error for {origin}-{destination}: {e}\nResponse: {resp.text}")
-            return pd.DataFrame()
-        df = pd.json_normalize(data)
-        if not df.empty:
-            df = df.rename(columns={"value": "price_eur"})
-        return df
+            return []
+        for record in data:
+            record.setdefault("origin", origin)
+            record.setdefault("destination", destination)
+        return data
     except Exception as e:
         print(f"API error for {origin}-{destination}: {e}")
-        return pd.DataFrame()
+        return []
+
+
+async def fetch_all_routes(routes):
+    # Issue every route request concurrently over one pooled keep-alive client
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+        retries=3
+    )
+    async with httpx.AsyncClient(
+        transport=transport,
+        # httpx rejects None header values; without a token each route
+        # request fails in fetch_route and is reported as an API error
+        headers={"x-access-token": TOKEN} if TOKEN else {},
+        timeout=30
+    ) as client:
+        return await asyncio.gather(
+            *[fetch_route(client, origin, destination) for origin, destination in routes]
+        )
 
 
 def main():
@@ -66,51 +142,92 @@ def main():
         ("NRT", "EZE")     # Tokyo to Buenos Aires
     ]
     
-    all_dfs = []
+    records = []
+    route_records = []
     print(f"\n📊 Fetching data for {len(ROUTES)} routes...")
+    results = asyncio.run(fetch_all_routes(ROUTES))
     
-    for i, (origin, destination) in enumerate(ROUTES, 1):
+    for i, ((origin, destination), data) in enumerate(zip(ROUTES, results), 1):
         print(f"   {i:2d}/10: {origin} → {destination}", end=" ... ")
-        df = fetch_route(origin, destination)
-        if not df.empty:
-            all_dfs.append(df)
-            # Save individual route data to snapshot directory
-            route_file = route_breakdown_dir / f"{origin.lower()}_{destination.lower()}_prices.csv"
-            df.to_csv(route_file, index=False)
-            print(f"✅ {len(df)} flights found")
+        if data:
+            # Keep each route's own records, keyed by the requested airports; the
+            # API may report city codes (e.g. ANK for ESB) in the data itself
+            route_records.append((origin, destination, data))
+            records.extend(data)
+            print(f"✅ {len(data)} flights found")
         else:
             print("❌ No data")
     
-    if all_dfs:
-        df_all = pd.concat(all_dfs, ignore_index=True)
+    if records:
+        # Build a single DataFrame from the raw API records of all routes
+        df_all = pd.DataFrame(records).rename(columns={"value": "price_eur"})
         
-        # Add metadata
-        df_all['collection_timestamp'] = timestamp.isoformat()
-        df_all['snapshot_date'] = date_str
-          # Save to snapshot directory
-        snapshot_file = snapshot_dir / "all_routes.csv"
-        df_all.to_csv(snapshot_file, index=False)
+        # Save individual route data on worker threads so those writes
+        # overlap with the combined snapshot writes below
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            route_writes = [
+                pool.submit(
+                    write_csv,
+                    pd.DataFrame(data).rename(columns={"value": "price_eur"}),
+                    route_breakdown_dir / f"{origin.lower()}_{destination.lower()}_prices.csv"
+                )
+                for origin, destination, data in route_records
+            ]
+            
+            # Add metadata as single-category columns (one string, N int8 codes)
+            metadata_codes = np.zeros(len(df_all), dtype=np.int8)
+            df_all['collection_timestamp'] = pd.Categorical.from_codes(
+                metadata_codes, categories=[timestamp.isoformat()]
+            )
+            df_all['snapshot_date'] = pd.Categorical.from_codes(metadata_codes, categories=[date_str])
+            # Save to snapshot directory
+            snapshot_file = snapshot_dir / "all_routes.csv"
+            write_csv(df_all, snapshot_file)
+            # Columnar copy for faster, dtype-preserving reads in the comparison analysis
+            df_all.to_parquet(snapshot_dir / "all_routes.parquet", engine="pyarrow",
+                              compression="snappy", index=False)
+            
+            # Surface any route write errors
+            for future in route_writes:
+                future.result()
+        
+        db_file = Path("snapshots") / "flights.duckdb"
+        try:
+            save_to_duckdb(df_all, db_file, date_str)
+            db_status = f"🗄️ Snapshot appended to: {db_file}"
+        except duckdb.IOException as e:
+            # e.g. locked by a running comparison; the analysis falls back to the files
+            db_status = f"⚠️ Could not write {db_file} ({e}); snapshot kept on disk only"
         
         print(f"\n✅ DATA COLLECTION COMPLETED")
         print(f"📁 Snapshot saved to: {snapshot_dir}")
+        print(db_status)
         print(f"📊 Total flights collected: {len(df_all)}")
-        print(f"📅 Date range: {df_all['depart_date'].min()} to {df_all['depart_date'].max()}")
-        print(f"💰 Price range: €{df_all['price_eur'].min()} - €{df_all['price_eur'].max()}")
-        print(f"💵 Average price: €{df_all['price_eur'].mean():.2f}")
+        # Summary statistics in a single aggregation call
+        stats = df_all.agg({'price_eur': ['min', 'max', 'mean'], 'depart_date': ['min', 'max']})
+        price_min, price_max, price_mean = stats['price_eur'][['min', 'max', 'mean']].astype(float)
+        date_min, date_max = stats.at['min', 'depart_date'], stats.at['max', 'depart_date']
+        print(f"📅 Date range: {date_min} to {date_max}")
+        print(f"💰 Price range: €{price_min:.2f} - €{price_max:.2f}")
+        print(f"💵 Average price: €{price_mean:.2f}")
         
         # Show cheapest flights by route
         print(f"\n🏆 CHEAPEST FLIGHTS BY ROUTE")
         print("-" * 40)
-        cheapest = df_all.groupby(['origin', 'destination'])['price_eur'].min().reset_index()
-        cheapest['route'] = cheapest['origin'] + ' → ' + cheapest['destination']
-        cheapest_sorted = cheapest.sort_values('price_eur')
-        for _, row in cheapest_sorted.iterrows():
-            print(f"   {row['route']}: €{row['price_eur']}")
+        cheapest_sorted = (
+            df_all.groupby(['origin', 'destination'], observed=True, sort=False)['price_eur']
+            .min()
+            .sort_values()
+            .reset_index()
+        )
+        cheapest_sorted['route'] = cheapest_sorted['origin'] + ' → ' + cheapest_sorted['destination']
+        for route, price in cheapest_sorted[['route', 'price_eur']].itertuples(index=False, name=None):
+            print(f"   {route}: €{price}")
         
         # Show OTA distribution
         print(f"\n🏢 OTA DISTRIBUTION")
         print("-" * 20)
-        ota_counts = df_all['gate'].value_counts()
+        ota_counts = df_all['gate'].value_counts(sort=False)
         for ota, count in ota_counts.items():
             print(f"   {ota}: {count} flights")
             
@@ -124,11 +241,11 @@ def main():
             'total_flights': len(df_all),
             'routes_covered': len(ROUTES),
             'active_otas': df_all['gate'].nunique(),
-            'price_range_min': float(df_all['price_eur'].min()),
-            'price_range_max': float(df_all['price_eur'].max()),
-            'average_price': float(df_all['price_eur'].mean()),
-            'date_range_start': df_all['depart_date'].min(),
-            'date_range_end': df_all['depart_date'].max()
+            'price_range_min': price_min,
+            'price_range_max': price_max,
+            'average_price': price_mean,
+            'date_range_start': date_min,
+            'date_range_end': date_max
         }
         
         summary_file = snapshot_dir / "snapshot_summary.json"
@@ -7,14 +7,37 @@ time periods and analyzing competitive pricing dynamics.
 Date: June 18, 2025
 """
 
+import os
+import sys
 import pandas as pd
 import numpy as np
+import polars as pl
+import duckdb
+import matplotlib
+
+# Headless Linux (cron, CI): use the non-interactive backend up front so
+# plt.show() is a no-op and no GUI toolkit gets initialised
+if (sys.platform.startswith('linux') and 'MPLBACKEND' not in os.environ
+        and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))):
+    matplotlib.use('Agg')
+
 import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime, timedelta
-import os
 from pathlib import Path
 import argparse
+from functools import lru_cache
+
+# Set up the plotting style once at import rather than for every report
+plt.style.use('seaborn-v0_8')
+plt.rcParams.update({
+    'font.size': 12,
+    'axes.titlesize': 14,
+    'axes.labelsize': 12,
+    'xtick.labelsize': 10,
+    'ytick.labelsize': 10,
+    'font.family': 'DejaVu Sans'  # For emojis
+})
 
 class FlightPriceComparator:
     """
@@ -22,79 +45,231 @@ class FlightPriceComparator:
     and analyzing competitive pricing dynamics.
     """
     
-    def __init__(self, snapshots_dir="snapshots"):
+    def __init__(self, snapshots_dir="snapshots", db_path=None):
         """
         Initialize the price comparator.
         
         Args:
             snapshots_dir (str): Directory containing snapshot subdirectories
+            db_path (str, optional): DuckDB database written by fetch_prices.py,
+                defaults to flights.duckdb inside snapshots_dir
         """
         self.snapshots_dir = Path(snapshots_dir)
+        self.db_path = Path(db_path) if db_path else self.snapshots_dir / "flights.duckdb"
         self.results_dir = Path("analysis_results")
         self.results_dir.mkdir(exist_ok=True)
+        # Bounded per-instance cache so repeated comparisons don't re-read snapshots
+        self._read_snapshot_cached = lru_cache(maxsize=8)(self._read_snapshot)
         
-    def load_snapshot(self, date_str):
+    def _snapshot_file(self, date_str):
         """
-        Load a specific snapshot by date.
+        Locate the file holding a snapshot.
+        
+        Prefers the Parquet copy of the snapshot and falls back to the CSV
+        for snapshots collected before Parquet output was added.
         
         Args:
             date_str (str): Date in YYYYMMDD format
             
         Returns:
-            pd.DataFrame: Flight price data for the specified date
+            Path: Path to all_routes.parquet or all_routes.csv
         """
+        parquet_path = self.snapshots_dir / date_str / "all_routes.parquet"
         snapshot_path = self.snapshots_dir / date_str / "all_routes.csv"
         
-        if not snapshot_path.exists():
-            raise FileNotFoundError(f"Snapshot not found: {snapshot_path}")
+        if parquet_path.exists():
+            return parquet_path
+        if snapshot_path.exists():
+            return snapshot_path
+        raise FileNotFoundError(f"Snapshot not found: {snapshot_path}")
+        
+    def _read_snapshot(self, path, columns, mtime_ns):
+        """
+        Read a snapshot file from disk.
+        
+        Args:
+            path (Path): Snapshot file from _snapshot_file()
+            columns (tuple): Subset of columns to load, or None for all
+            mtime_ns (int): File modification time; only part of the cache
+                key, so a re-fetched snapshot is read again
+            
+        Returns:
+            pd.DataFrame: Flight price data as stored on disk
+        """
+        columns = list(columns) if columns is not None else None
+        
+        if path.suffix == '.parquet':
+            return pd.read_parquet(path, columns=columns, dtype_backend='pyarrow')
+        # Keep depart_date as text (Arrow would infer date32) so CSV and
+        # Parquet snapshots produce identical join keys
+        return pd.read_csv(path, usecols=columns, engine='pyarrow',
+                           dtype_backend='pyarrow', dtype={'depart_date': 'string[pyarrow]'})
+        
+    def load_snapshot(self, date_str, columns=None):
+        """
+        Load a specific snapshot by date.
+        
+        Snapshots are cached in memory, so loading the same date again
+        returns a copy without re-reading the file, unless the file has
+        been rewritten since it was cached.
+        
+        Args:
+            date_str (str): Date in YYYYMMDD format
+            columns (list, optional): Subset of columns to load
             
-        df = pd.read_csv(snapshot_path)
+        Returns:
+            pd.DataFrame: Flight price data for the specified date
+        """
+        if columns is not None:
+            columns = tuple(columns)
+        path = self._snapshot_file(date_str)
+        df = self._read_snapshot_cached(path, columns, path.stat().st_mtime_ns).copy()
         df['snapshot_date'] = date_str
         return df
         
-    def compare_snapshots(self, date1, date2):
+    def _join_in_duckdb(self, date1, date2):
         """
-        Compare two snapshots and calculate price differences. (right now only for two dates)
+        Join two snapshots inside the DuckDB flights table.
         
         Args:
             date1 (str): Earlier date in YYYYMMDD format
             date2 (str): Later date in YYYYMMDD format
             
         Returns:
-            pd.DataFrame: Merged dataframe with price comparison metrics
+            pd.DataFrame: Matched flights with new and old prices, or None if
+            the database or either snapshot date is not available
         """
-        print(f"📊 Comparing snapshots: {date1} vs {date2}")
+        if not self.db_path.exists():
+            return None
+            
+        try:
+            con = duckdb.connect(str(self.db_path), read_only=True)
+        except duckdb.IOException:
+            # Database is locked, e.g. while fetch_prices.py is writing to it
+            return None
+            
+        try:
+            counts = dict(con.execute("""
+                SELECT snapshot_date, count(*) FROM flights
+                WHERE snapshot_date IN (?, ?)
+                GROUP BY snapshot_date
+            """, [date1, date2]).fetchall())
+            if date1 not in counts or date2 not in counts:
+                return None
+                
+            print(f"   • {date1}: {counts[date1]} records")
+            print(f"   • {date2}: {counts[date2]} records")
+            
+            # Self-join on the key columns, in the newer snapshot's row order
+            merged = con.execute("""
+                SELECT n.origin, n.destination, n.depart_date, n.gate,
+                       n.price_eur AS price_eur_new, o.price_eur AS price_eur_old
+                FROM flights n
+                JOIN flights o
+                  ON n.origin = o.origin AND n.destination = o.destination
+                 AND n.depart_date = o.depart_date AND n.gate = o.gate
+                WHERE n.snapshot_date = ? AND o.snapshot_date = ?
+                ORDER BY n.rowid, o.rowid
+            """, [date2, date1]).df()
+        except duckdb.CatalogException:
+            return None
+        finally:
+            con.close()
+            
+        # price_eur is stored as DOUBLE; return whole-euro prices as integers,
+        # as the snapshot files give them, so both join paths report the same dtypes
+        prices = merged[['price_eur_new', 'price_eur_old']]
+        if prices.notna().all().all() and (prices % 1 == 0).all().all():
+            merged[['price_eur_new', 'price_eur_old']] = prices.astype('int64')
+        return merged
+            
+    def _join_snapshot_files(self, date1, date2):
+        """
+        Join two snapshots loaded from their snapshot files.
         
-        # Load both snapshots
-        df1 = self.load_snapshot(date1)
-        df2 = self.load_snapshot(date2)
+        Args:
+            date1 (str): Earlier date in YYYYMMDD format
+            date2 (str): Later date in YYYYMMDD format
+            
+        Returns:
+            pd.DataFrame: Matched flights with new and old prices
+        """
+        # Create matching keys for comparison
+        merge_cols = ['origin', 'destination', 'depart_date', 'gate']
+        
+        # Load both snapshots (only the columns used below)
+        df1 = self.load_snapshot(date1, columns=merge_cols + ['price_eur'])
+        df2 = self.load_snapshot(date2, columns=merge_cols + ['price_eur'])
         
         print(f"   • {date1}: {len(df1)} records")
         print(f"   • {date2}: {len(df2)} records")
         
-        # Create matching keys for comparison
-        merge_cols = ['origin', 'destination', 'depart_date', 'gate']
-        
-        # Merge on common flights
+        # Merge on common flights, joining on a single 64-bit fingerprint of
+        # the key columns rather than on the four object columns themselves
+        new_prices = df2[merge_cols + ['price_eur']].assign(
+            _key=pd.util.hash_pandas_object(df2[merge_cols], index=False).to_numpy()
+        )
+        old_prices = df1[['price_eur']].assign(
+            _key=pd.util.hash_pandas_object(df1[merge_cols], index=False).to_numpy()
+        )
         merged = pd.merge(
-            df2[merge_cols + ['price_eur']],
-            df1[merge_cols + ['price_eur']],
-            on=merge_cols,
+            new_prices,
+            old_prices,
+            on='_key',
             suffixes=('_new', '_old'),
             how='inner'
+        ).drop(columns='_key')
+        
+        return merged
+        
+    def compare_snapshots(self, date1, date2):
+        """
+        Compare two snapshots and calculate price differences. (right now only for two dates)
+        
+        Args:
+            date1 (str): Earlier date in YYYYMMDD format
+            date2 (str): Later date in YYYYMMDD format
+            
+        Returns:
+            pd.DataFrame: Merged dataframe with price comparison metrics
+        """
+        print(f"📊 Comparing snapshots: {date1} vs {date2}")
+        
+        # Prefer the DuckDB store; older snapshots only exist as files
+        merged = self._join_in_duckdb(date1, date2)
+        if merged is None:
+            merged = self._join_snapshot_files(date1, date2)
+        
+        # Calculate price changes on the raw arrays in a single pass; a zero
+        # old price leaves the percentage as NaN instead of ±inf
+        old_price = merged['price_eur_old'].to_numpy()
+        price_diff = merged['price_eur_new'].to_numpy() - old_price
+        change_pct = np.full(price_diff.shape, np.nan)
+        np.divide(price_diff, old_price, out=change_pct, where=old_price != 0)
+        change_pct *= 100
+        merged['price_diff'] = price_diff
+        merged['change_pct'] = change_pct
+        
+        # Categorical keys let the later groupbys work on integer codes;
+        # route labels are formatted once per distinct pair, not per row
+        for col in ('origin', 'destination', 'gate'):
+            merged[col] = merged[col].astype('category')
+        route_codes, route_pairs = pd.factorize(
+            pd.MultiIndex.from_arrays([merged['origin'], merged['destination']]), sort=True
+        )
+        merged['route'] = pd.Categorical.from_codes(
+            route_codes, categories=[f"{origin} → {dest}" for origin, dest in route_pairs]
         )
         
-        # Calculate price changes
-        merged['price_diff'] = merged['price_eur_new'] - merged['price_eur_old']
-        merged['change_pct'] = (merged['price_diff'] / merged['price_eur_old']) * 100
-        merged['route'] = merged['origin'] + ' → ' + merged['destination']
-        
-        # Categorize changes
-        merged['change_type'] = pd.cut(
-            merged['change_pct'],
-            bins=[-float('inf'), -5, -1, 1, 5, float('inf')],
-            labels=['Major Drop (>5%)', 'Minor Drop (1-5%)', 'Stable (±1%)', 
-                   'Minor Increase (1-5%)', 'Major Increase (>5%)']
+        # Categorize changes (right-closed bins, one vectorized bucket lookup)
+        change_pct = merged['change_pct'].to_numpy()
+        change_codes = np.searchsorted(np.array([-5, -1, 1, 5]), change_pct)
+        change_codes[np.isnan(change_pct)] = -1
+        merged['change_type'] = pd.Categorical.from_codes(
+            change_codes,
+            categories=['Major Drop (>5%)', 'Minor Drop (1-5%)', 'Stable (±1%)', 
+                        'Minor Increase (1-5%)', 'Major Increase (>5%)'],
+            ordered=True
         )
         
         print(f"   • Matched flights: {len(merged)}")
@@ -102,6 +277,39 @@ class FlightPriceComparator:
         
         return merged
         
+    def _aggregate_changes(self, comparison_df, key, extra_col, extra_agg):
+        """
+        Aggregate price changes per group in a single polars pass.
+        
+        Args:
+            comparison_df (pd.DataFrame): Result from compare_snapshots()
+            key (str): Column to group by
+            extra_col (str): Additional column needed by extra_agg
+            extra_agg (pl.Expr): Aggregation added after the shared change metrics
+            
+        Returns:
+            pd.DataFrame: Aggregated metrics indexed by key, rounded to 2 decimals
+        """
+        return (
+            pl.from_pandas(comparison_df[[key, 'price_diff', 'change_pct', extra_col]])
+            .lazy()
+            .group_by(key)
+            .agg([
+                pl.col('price_diff').count().alias('total_flights'),
+                pl.col('price_diff').mean().alias('avg_price_diff'),
+                pl.col('price_diff').std().alias('std_price_diff'),
+                pl.col('change_pct').mean().alias('avg_change_pct'),
+                pl.col('change_pct').min().alias('min_change_pct'),
+                pl.col('change_pct').max().alias('max_change_pct'),
+                extra_agg
+            ])
+            .sort(key)
+            .collect()
+            .to_pandas()
+            .set_index(key)
+            .round(2)
+        )
+        
     def analyze_ota_changes(self, comparison_df):
         """
         Analyze price changes by OTA.
@@ -112,27 +320,22 @@ class FlightPriceComparator:
         Returns:
             pd.DataFrame: OTA-level price change analysis
         """
-        ota_analysis = comparison_df.groupby('gate').agg({
-            'price_diff': ['count', 'mean', 'std'],
-            'change_pct': ['mean', 'min', 'max'],
-            'price_eur_new': 'mean'
-        }).round(2)
-        
-        # Flatten column names
-        ota_analysis.columns = [
-            'total_flights', 'avg_price_diff', 'std_price_diff',
-            'avg_change_pct', 'min_change_pct', 'max_change_pct', 'avg_current_price'
-        ]
-        
-        # Add strategy classification
-        ota_analysis['pricing_strategy'] = ota_analysis['avg_change_pct'].apply(
-            lambda x: 'Aggressive Increase' if x > 5 
-                     else 'Moderate Increase' if x > 1
-                     else 'Stable' if abs(x) <= 1
-                     else 'Moderate Decrease' if x > -5
-                     else 'Aggressive Decrease'
+        ota_analysis = self._aggregate_changes(
+            comparison_df, 'gate', 'price_eur_new',
+            pl.col('price_eur_new').mean().alias('avg_current_price')
         )
         
+        # Add strategy classification; the -1 edge is nudged down so that
+        # exactly -1% still lands in the closed Stable band [-1, 1]
+        strategy_edges = np.array([-5, np.nextafter(-1, -np.inf), 1, 5])
+        strategies = np.array(['Aggressive Decrease', 'Moderate Decrease', 'Stable',
+                               'Moderate Increase', 'Aggressive Increase'])
+        avg_change_pct = ota_analysis['avg_change_pct'].to_numpy()
+        strategy_codes = np.searchsorted(strategy_edges, avg_change_pct)
+        # searchsorted sorts NaN last; keep the original mapping to Aggressive Decrease
+        strategy_codes[np.isnan(avg_change_pct)] = 0
+        ota_analysis['pricing_strategy'] = strategies[strategy_codes]
+        
         return ota_analysis.sort_values('avg_change_pct', ascending=False)
         
     def analyze_route_changes(self, comparison_df):
@@ -145,17 +348,10 @@ class FlightPriceComparator:
         Returns:
             pd.DataFrame: Route-level price change analysis
         """
-        route_analysis = comparison_df.groupby('route').agg({
-            'price_diff': ['count', 'mean', 'std'],
-            'change_pct': ['mean', 'min', 'max'],
-            'gate': 'nunique'
-        }).round(2)
-        
-        # Flatten column names
-        route_analysis.columns = [
-            'total_flights', 'avg_price_diff', 'std_price_diff',
-            'avg_change_pct', 'min_change_pct', 'max_change_pct', 'num_otas'
-        ]
+        route_analysis = self._aggregate_changes(
+            comparison_df, 'route', 'gate',
+            pl.col('gate').drop_nulls().n_unique().alias('num_otas')
+        )
         
         return route_analysis.sort_values('avg_change_pct', ascending=False)
         
@@ -168,16 +364,6 @@ class FlightPriceComparator:
             date1 (str): Earlier date
             date2 (str): Later date
         """
-        # Set up the plotting style with improved font settings
-        plt.style.use('seaborn-v0_8')
-        plt.rcParams.update({
-            'font.size': 12,
-            'axes.titlesize': 14,
-            'axes.labelsize': 12,
-            'xtick.labelsize': 10,
-            'ytick.labelsize': 10,
-            'font.family': 'DejaVu Sans'  # For emojis
-        })        
         fig = plt.figure(figsize=(24, 18), constrained_layout=False)
         gs = fig.add_gridspec(3, 3, width_ratios=[1, 1, 1], hspace=0.4, wspace=0.3)
           # 1. Price Change Distribution
@@ -204,7 +390,7 @@ class FlightPriceComparator:
         
         # 3. OTA Average Change
         ax3 = plt.subplot(gs[0, 2])
-        ota_avg = comparison_df.groupby('gate')['change_pct'].mean().sort_values()
+        ota_avg = comparison_df.groupby('gate', observed=True)['change_pct'].mean().sort_values()
         bars = ax3.barh(range(len(ota_avg)), ota_avg.values, 
                        color=['red' if x < 0 else 'green' for x in ota_avg.values])
         ax3.set_yticks(range(len(ota_avg)))
@@ -214,7 +400,7 @@ class FlightPriceComparator:
         ax3.axvline(0, color='black', linestyle='-', alpha=0.3)
           # 4. Route Average Change
         ax4 = plt.subplot(gs[1, 0])
-        route_avg = comparison_df.groupby('route')['change_pct'].mean().sort_values()
+        route_avg = comparison_df.groupby('route', observed=True)['change_pct'].mean().sort_values()
         ax4.barh(range(len(route_avg)), route_avg.values,
                 color=['red' if x < 0 else 'green' for x in route_avg.values])
         ax4.set_yticks(range(len(route_avg)))
@@ -236,7 +422,7 @@ class FlightPriceComparator:
         biggest_increases = comparison_df.nlargest(10, 'price_diff')
         ax6.barh(range(len(biggest_increases)), biggest_increases['price_diff'], color='red', alpha=0.7)
         ax6.set_yticks(range(len(biggest_increases)))
-        ax6.set_yticklabels([f"{row['gate']}: {row['route']}" for _, row in biggest_increases.iterrows()], fontsize=7)
+        ax6.set_yticklabels([f"{gate}: {route}" for gate, route in biggest_increases[['gate', 'route']].itertuples(index=False, name=None)], fontsize=7)
         ax6.set_title('Biggest Price Increases (EUR)', fontweight='bold')
         ax6.set_xlabel('Price Increase (€)')
         
@@ -245,7 +431,7 @@ class FlightPriceComparator:
         biggest_decreases = comparison_df.nsmallest(10, 'price_diff')
         ax7.barh(range(len(biggest_decreases)), biggest_decreases['price_diff'], color='green', alpha=0.7)
         ax7.set_yticks(range(len(biggest_decreases)))
-        ax7.set_yticklabels([f"{row['gate']}: {row['route']}" for _, row in biggest_decreases.iterrows()], fontsize=7)
+        ax7.set_yticklabels([f"{gate}: {route}" for gate, route in biggest_decreases[['gate', 'route']].itertuples(index=False, name=None)], fontsize=7)
         ax7.set_title('Biggest Price Decreases (EUR)', fontweight='bold')
         ax7.set_xlabel('Price Decrease (€)')        # 8. OTA Market Share
         ax8 = plt.subplot(gs[2, 1])
@@ -289,13 +475,15 @@ Routes Monitored: {comparison_df['route'].nunique()}        """
         plt.subplots_adjust(left=0.05, bottom=0.05, right=0.96, top=0.95, 
                            wspace=0.35, hspace=0.45)  
         
-        # Save the visualization with higher DPI
+        # Save the visualization at screen resolution with fast PNG compression
         filename = f"price_comparison_{date1}_to_{date2}.png"
         filepath = self.results_dir / filename
-        plt.savefig(filepath, dpi=400, bbox_inches='tight')  
+        plt.savefig(filepath, dpi=150, bbox_inches='tight',
+                    pil_kwargs={'optimize': False, 'compress_level': 1})
         print(f"📊 Visualization saved: {filepath}")
         
         plt.show()
+        plt.close(fig)
         
     def generate_comparison_report(self, date1, date2):
         """
@@ -357,11 +545,12 @@ def main():
     parser.add_argument('--date1', required=True, help='Earlier date (YYYYMMDD)')
     parser.add_argument('--date2', required=True, help='Later date (YYYYMMDD)')
     parser.add_argument('--snapshots-dir', default='snapshots', help='Snapshots directory')
+    parser.add_argument('--db-path', help='DuckDB database (default: <snapshots-dir>/flights.duckdb)')
     
     args = parser.parse_args()
     
     # Initialize comparator
-    comparator = FlightPriceComparator(args.snapshots_dir)
+    comparator = FlightPriceComparator(args.snapshots_dir, args.db_path)
     
     # Generate report
     comparator.generate_comparison_report(args.date1, args.date2)